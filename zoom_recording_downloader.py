@@ -3,29 +3,134 @@ import os
 import re
 import json
 import time
+import queue
+import atexit
+import logging
+import logging.handlers
 import pathlib
+import threading
 import datetime as dt
+from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from typing import Callable
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 ZOOM_TOKEN_URL = "https://zoom.us/oauth/token"
 ZOOM_API_BASE = "https://api.zoom.us/v2"
 
+log = logging.getLogger("zoom_recording_downloader")
+
+# Refresh access tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 60
+
+# Transient statuses retried by the HTTP adapter
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Default extensions for recording file types that come without one
+_EXT_BY_TYPE = {
+    "MP4": "mp4",
+    "M4A": "m4a",
+    "CHAT": "txt",
+    "VTT": "vtt",
+    "TRANSCRIPT": "vtt",
+}
+
+# Compiled once; sanitize() runs on several fields of every meeting
+_UNSAFE_CHARS = re.compile(r"[^\w\-\.\(\)\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+# Size of the per-thread buffer recording downloads are read into
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+_download_buffers = threading.local()
+
+# How long listings of past months are reused without revalidation (seconds)
+LISTING_CACHE_TTL = 30 * 24 * 3600
+
 def env(name: str, default: str | None = None) -> str:
     v = os.environ.get(name, default)
     if not v:
         raise SystemExit(f"Missing required env var: {name}")
     return v
 
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Settings read from the environment once at startup.
+    """
+    account_id: str
+    client_id: str
+    client_secret: str
+    user_id: str = "all"
+    out_dir: pathlib.Path = pathlib.Path("./zoom_recordings")
+    months_back: int = 4
+    parallel: int = 6
+    list_parallel: int = 8
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE
+    download_interval: float = 0.2
+
+def load_config() -> Config:
+    return Config(
+        # === REQUIRED ENV VARS ===
+        account_id=env("ZOOM_ACCOUNT_ID"),
+        client_id=env("ZOOM_CLIENT_ID"),
+        client_secret=env("ZOOM_CLIENT_SECRET"),
+        # user_id can be: "all" (default - all users), "me" (current user), a Zoom userId, or an email
+        # If not set, defaults to "all" to get all org recordings
+        user_id=os.environ.get("ZOOM_USER_ID", "all"),
+        # Local output folder (optional, defaults to ./zoom_recordings)
+        out_dir=pathlib.Path(os.environ.get("ZOOM_OUT_DIR", "./zoom_recordings")).expanduser().resolve(),
+        # How far back to pull (months, optional, defaults to 4)
+        months_back=int(os.environ.get("ZOOM_MONTHS_BACK", "4")),
+        # Number of files downloaded in parallel (optional, defaults to 6)
+        parallel=int(os.environ.get("ZOOM_PARALLEL", "6")),
+    )
+
+def make_session() -> requests.Session:
+    """
+    Build a Session with a pooled, retrying HTTPS adapter so connections (and TLS handshakes)
+    are reused across the many listing and download calls of a run.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,  # hand the final response back so callers can report it
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+    return session
+
+class RateLimiter:
+    """
+    Spaces out calls across threads so at most one proceeds every `interval` seconds.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
 def sanitize(s: str, max_len: int = 120) -> str:
     s = (s or "").strip()
-    s = re.sub(r"[^\w\-\.\(\)\s]+", "", s)
-    s = re.sub(r"\s+", " ", s)
+    s = _UNSAFE_CHARS.sub("", s)
+    s = _WHITESPACE.sub(" ", s)
     return s[:max_len].strip() or "untitled"
 
-def get_s2s_access_token(account_id: str, client_id: str, client_secret: str) -> str:
+def get_s2s_access_token(session: requests.Session, account_id: str, client_id: str, client_secret: str) -> tuple[str, float]:
+    """
+    Returns the access token and the time.time() at which it expires.
+    """
     # Server-to-Server OAuth: grant_type=account_credentials&account_id=...
     # Uses Basic Auth with client_id/client_secret
     # Request required scopes for cloud recording access
@@ -38,7 +143,7 @@ def get_s2s_access_token(account_id: str, client_id: str, client_secret: str) ->
     # If you need to limit scopes, uncomment and modify the line below:
     # params["scope"] = "cloud_recording:read:list_user_recordings cloud_recording:read:list_user_recordings:admin user:read:list_users:admin"
     
-    resp = requests.post(
+    resp = session.post(
         ZOOM_TOKEN_URL,
         params=params,
         auth=(client_id, client_secret),
@@ -50,24 +155,62 @@ def get_s2s_access_token(account_id: str, client_id: str, client_secret: str) ->
     token_data = resp.json()
     # Debug: Check what scopes were actually granted
     if "scope" in token_data:
-        print(f"Token granted scopes: {token_data['scope']}")
+        log.info(f"Token granted scopes: {token_data['scope']}")
     
-    return token_data["access_token"]
+    return token_data["access_token"], time.time() + token_data.get("expires_in", 3600)
 
-def zoom_get(path: str, token_container: dict, params: dict | None = None, refresh_token_callback: Callable[[], str] | None = None) -> dict:
+def token_expiring(token_container: dict) -> bool:
+    """
+    True when the container's token expires within TOKEN_REFRESH_MARGIN seconds.
+    """
+    return time.time() >= token_container.get("expires_at", float("inf")) - TOKEN_REFRESH_MARGIN
+
+def load_cached_response(cache_path: pathlib.Path) -> dict | None:
+    try:
+        return json.loads(cache_path.read_text("utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def store_cached_response(cache_path: pathlib.Path, resp: requests.Response, body: dict) -> None:
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(cache_path.suffix + ".tmp")
+    tmp_path.write_text(json.dumps({
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "body": body,
+    }), "utf-8")
+    tmp_path.replace(cache_path)
+
+def zoom_get(session: requests.Session, path: str, token_container: dict, params: dict | None = None, refresh_token_callback: Callable[[str | None], str] | None = None, cache_path: pathlib.Path | None = None, cache_ttl: float | None = None) -> dict:
     """
     Make a GET request to Zoom API with automatic token refresh on expiration.
     
     Args:
+        session: API session; its Authorization header is kept current by the refresh callback
         path: API endpoint path
-        token_container: Dict with 'token' key holding the current access token (will be updated if refreshed)
+        token_container: Dict with 'token' key holding the current access token (updated by the refresh callback)
         params: Optional query parameters
-        refresh_token_callback: Optional callback function that returns a new token when called
+        refresh_token_callback: Optional callback returning a fresh token; called with None ahead of expiry, or with a rejected token
+        cache_path: Optional file caching the response body with its ETag/Last-Modified, revalidated with a conditional GET
+        cache_ttl: Optional age in seconds within which a cached response is returned without any request
     """
+    headers = {}
+    cached = load_cached_response(cache_path) if cache_path else None
+    if cached is not None:
+        if cache_ttl is not None and time.time() - cache_path.stat().st_mtime < cache_ttl:
+            return cached["body"]
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    # Refresh ahead of expiry so the common path never pays for a rejected request
+    if refresh_token_callback and token_expiring(token_container):
+        refresh_token_callback(None)
     token = token_container["token"]
-    resp = requests.get(
+    resp = session.get(
         f"{ZOOM_API_BASE}{path}",
-        headers={"Authorization": f"Bearer {token}"},
+        headers=headers,
         params=params or {},
         timeout=60,
     )
@@ -78,100 +221,176 @@ def zoom_get(path: str, token_container: dict, params: dict | None = None, refre
             error_data = resp.json()
             if error_data.get("code") == 124 and refresh_token_callback:
                 # Token expired, refresh and retry
-                print("Access token expired, refreshing...")
-                new_token = refresh_token_callback()
-                token_container["token"] = new_token  # Update the token container
-                # Retry the request with new token
-                resp = requests.get(
+                log.info("Access token expired, refreshing...")
+                refresh_token_callback(token)
+                # Retry the request with new token (the callback updated the container and session header)
+                resp = session.get(
                     f"{ZOOM_API_BASE}{path}",
-                    headers={"Authorization": f"Bearer {new_token}"},
+                    headers=headers,
                     params=params or {},
                     timeout=60,
                 )
-                if resp.status_code != 200:
+                if resp.status_code not in (200, 304):
                     raise SystemExit(f"Zoom API error {resp.status_code} for {path} (after token refresh): {resp.text}")
-                return resp.json()
         except (json.JSONDecodeError, KeyError):
             pass  # Not a token expiration error, fall through to normal error handling
     
+    if resp.status_code == 304 and cached is not None:
+        cache_path.touch()  # revalidated, restart the TTL
+        return cached["body"]
     if resp.status_code != 200:
         raise SystemExit(f"Zoom API error {resp.status_code} for {path}: {resp.text}")
-    return resp.json()
+    body = resp.json()
+    if cache_path:
+        store_cached_response(cache_path, resp, body)
+    return body
 
-def add_access_token_to_download_url(download_url: str, token: str) -> str:
+def download_buffer(size: int = DOWNLOAD_CHUNK_SIZE) -> bytearray:
     """
-    Zoom cloud recording downloads may require adding `access_token` to the download_url
-    to access protected recordings.  [oai_citation:2‡Harvard APIs Portal](https://portal.apis.huit.harvard.edu/docs/ccs-zoom-api/1/routes/users/%7BuserId%7D/recordings/get?utm_source=chatgpt.com)
+    Return this thread's reusable download buffer, allocating it on first use.
     """
-    u = urlparse(download_url)
-    q = parse_qs(u.query)
-    q["access_token"] = [token]
-    new_query = urlencode(q, doseq=True)
-    return urlunparse((u.scheme, u.netloc, u.path, u.params, new_query, u.fragment))
+    buf = getattr(_download_buffers, "buf", None)
+    if buf is None or len(buf) != size:
+        buf = _download_buffers.buf = bytearray(size)
+    return buf
 
-def stream_download(url: str, out_path: pathlib.Path, token_container: dict | None = None, refresh_token_callback: Callable[[], str] | None = None) -> None:
+def stream_download(session: requests.Session, url: str, out_path: pathlib.Path, token_container: dict | None = None, refresh_token_callback: Callable[[str | None], str] | None = None, chunk_size: int = DOWNLOAD_CHUNK_SIZE, expected_size: int | None = None) -> None:
     """
     Download a file from URL with automatic token refresh on expiration.
     
     Args:
-        url: Download URL (may contain access_token parameter)
+        session: Download session (no default auth header; requests drops the per-request one on redirects to CDN hosts)
+        url: Download URL
         out_path: Local path to save the file
-        token_container: Optional dict with 'token' key (will be updated if refreshed)
-        refresh_token_callback: Optional callback function that returns a new token when called
+        token_container: Optional dict with 'token' key, sent as a Bearer header (updated by the refresh callback)
+        refresh_token_callback: Optional callback returning a fresh token; called with None ahead of expiry, or with a rejected token
+        chunk_size: Size of the read buffer in bytes
+        expected_size: Optional size reported by Zoom, used to judge a leftover .part file before any request
     """
     out_path.parent.mkdir(parents=True, exist_ok=True)
     tmp_path = out_path.with_suffix(out_path.suffix + ".part")
 
-    max_retries = 2
-    current_url = url
-    for attempt in range(max_retries):
+    if expected_size and tmp_path.exists():
+        part_size = tmp_path.stat().st_size
+        if part_size == expected_size:
+            # An earlier run finished the transfer but stopped before the rename
+            tmp_path.replace(out_path)
+            return
+        if part_size > expected_size:
+            tmp_path.unlink()  # cannot be a prefix of the recording, start over
+
+    max_attempts = 5
+    token_refreshed = False
+    for attempt in range(max_attempts):
+        # Resume from whatever an earlier attempt (or an interrupted run) left in the .part file
+        start = tmp_path.stat().st_size if tmp_path.exists() else 0
+        headers = {"Range": f"bytes={start}-"} if start else {}
+        if token_container:
+            if refresh_token_callback and token_expiring(token_container):
+                refresh_token_callback(None)
+            token = token_container["token"]
+            headers["Authorization"] = f"Bearer {token}"
         try:
-            with requests.get(current_url, stream=True, timeout=120) as r:
+            with session.get(url, headers=headers, stream=True, timeout=120) as r:
                 # Check for token expiration (401)
-                if r.status_code == 401 and token_container and refresh_token_callback and attempt < max_retries - 1:
-                    print("  Download token expired, refreshing...")
-                    new_token = refresh_token_callback()
-                    token_container["token"] = new_token
-                    # Rebuild URL with new token - extract base URL and add new token
-                    u = urlparse(current_url)
-                    q = parse_qs(u.query)
-                    q["access_token"] = [new_token]  # Update or add access_token
-                    new_query = urlencode(q, doseq=True)
-                    current_url = urlunparse((u.scheme, u.netloc, u.path, u.params, new_query, u.fragment))
+                if r.status_code == 401 and token_container and refresh_token_callback and not token_refreshed:
+                    log.info("  Download token expired, refreshing...")
+                    refresh_token_callback(token)  # updates token_container under its lock
+                    token_refreshed = True
                     continue  # Retry with new token
-                
+
+                if r.status_code == 416:
+                    # Nothing past `start`: the .part is either already complete or stale
+                    total = r.headers.get("Content-Range", "").rpartition("/")[2]
+                    if total.isdigit() and int(total) == start:
+                        break
+                    tmp_path.unlink(missing_ok=True)
+                    continue
+
                 r.raise_for_status()
-                with open(tmp_path, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=1024 * 1024):
-                        if chunk:
-                            f.write(chunk)
-                break  # Success
+                # 206 continues the .part file; 200 means the server ignored Range, so start over
+                mode = "ab" if r.status_code == 206 else "wb"
+                if r.status_code == 206:
+                    range_spec, _, total = r.headers.get("Content-Range", "").removeprefix("bytes ").partition("/")
+                    if range_spec.partition("-")[0] != str(start):
+                        # Body does not continue where the .part ends; appending it would corrupt the file
+                        tmp_path.unlink(missing_ok=True)
+                        continue
+                elif r.headers.get("Content-Encoding", "identity") == "identity":
+                    total = r.headers.get("Content-Length", "")
+                else:
+                    total = ""  # Content-Length counts encoded bytes, not the decoded ones written to disk
+                # Completeness is judged by the response's own size, not the listing's file_size
+                total = int(total) if total.isdigit() else None
+                # Read into this thread's reused buffer and write it unbuffered. urllib3's readinto() still reads
+                # each chunk into a temporary bytes and copies it into `buf`; the file layer adds no further copy
+                r.raw.decode_content = True
+                buf = download_buffer(chunk_size)
+                view = memoryview(buf)
+                with open(tmp_path, mode, buffering=0) as f:
+                    while n := r.raw.readinto(buf):
+                        # One write() syscall per chunk; an unbuffered write may be short, so finish it
+                        written = f.write(view[:n])
+                        while written < n:
+                            written += f.write(view[written:n])
+                    # Make the data durable before the rename publishes it under the final name
+                    os.fsync(f.fileno())
+
+                size = tmp_path.stat().st_size
+                if total is None or size == total:
+                    break  # Success
+                log.info(f"  Got {size} of {total} bytes for {out_path.name}, retrying...")
+                if size > total:
+                    tmp_path.unlink()  # not a prefix of the recording, start over
         except requests.exceptions.HTTPError as e:
-            if e.response and e.response.status_code == 401 and token_container and refresh_token_callback and attempt < max_retries - 1:
-                # Token expired, refresh and retry
-                print("  Download token expired, refreshing...")
-                new_token = refresh_token_callback()
-                token_container["token"] = new_token
-                # Rebuild URL with new token
-                u = urlparse(current_url)
-                q = parse_qs(u.query)
-                q["access_token"] = [new_token]
-                new_query = urlencode(q, doseq=True)
-                current_url = urlunparse((u.scheme, u.netloc, u.path, u.params, new_query, u.fragment))
-                continue
-            raise
+            if e.response is None or e.response.status_code < 500 or attempt == max_attempts - 1:
+                raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError):
+            if attempt == max_attempts - 1:
+                raise
+        # Transient failure or short transfer: back off, then resume from the bytes already on disk
+        time.sleep(min(2 ** attempt, 30))
+    else:
+        raise RuntimeError(f"Download did not complete after {max_attempts} attempts")
 
     tmp_path.replace(out_path)
 
 def load_manifest(root: pathlib.Path) -> dict:
-    p = root / "manifest.json"
-    if p.exists():
-        return json.loads(p.read_text("utf-8"))
-    return {"downloaded": {}}
+    """
+    Rebuild the manifest from the append-only manifest.jsonl log.
+    Each line is {section: {key: value}}; later lines win. A legacy manifest.json, if present, is read first.
+    """
+    manifest = {"downloaded": {}, "complete_meetings": {}}
+    legacy = root / "manifest.json"
+    if legacy.exists():
+        manifest.update(json.loads(legacy.read_text("utf-8")))
 
-def save_manifest(root: pathlib.Path, manifest: dict) -> None:
-    p = root / "manifest.json"
-    p.write_text(json.dumps(manifest, indent=2, sort_keys=True), "utf-8")
+    p = root / "manifest.jsonl"
+    if p.exists():
+        torn = False
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                torn = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # blank or torn line from an interrupted run
+                for section, entries in record.items():
+                    manifest.setdefault(section, {}).update(entries)
+        if torn:
+            # Terminate a final line cut off by an interrupted run so the next append starts on its own line
+            with open(p, "a", encoding="utf-8") as f:
+                f.write("\n")
+    return manifest
+
+def append_manifest(root: pathlib.Path, section: str, key: str, value) -> None:
+    """
+    Append a single manifest entry as one JSON line (constant-time and crash-safe).
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    with open(root / "manifest.jsonl", "a", encoding="utf-8", buffering=1) as f:
+        # Same line as json.dumps({section: {key: value}}), without building the wrapper dicts
+        f.write(f"{{{json.dumps(section)}: {{{json.dumps(key)}: {json.dumps(value)}}}}}\n")
 
 def month_windows_back(months_back: int) -> list[tuple[str, str]]:
     """
@@ -193,12 +412,17 @@ def month_windows_back(months_back: int) -> list[tuple[str, str]]:
     windows.insert(0, (first_of_this_month.isoformat(), today.isoformat()))
     return windows
 
-def list_user_recordings(user_id: str, token_container: dict, from_date: str, to_date: str, refresh_token_callback: Callable[[], str] | None = None) -> list[dict]:
+def list_user_recordings(session: requests.Session, user_id: str, token_container: dict, from_date: str, to_date: str, refresh_token_callback: Callable[[str | None], str] | None = None, cache_dir: pathlib.Path | None = None) -> list[dict]:
     # GET /users/{userId}/recordings
     # Returns meetings array with recording_files inside each meeting.  [oai_citation:4‡Harvard APIs Portal](https://portal.apis.huit.harvard.edu/docs/ccs-zoom-api/1/routes/users/%7BuserId%7D/recordings/get?utm_source=chatgpt.com)
     meetings = []
     next_token = None
 
+    # Listings of months that have already ended rarely change, so they are served from cache for a while.
+    # The open month-to-date window changes daily (and its to_date with it), so it is never cached.
+    closed_month = to_date < dt.date.today().replace(day=1).isoformat()
+    cache_path = cache_dir / f"{sanitize(user_id, 80)}_{from_date}_{to_date}.json" if cache_dir and closed_month else None
+
     while True:
         params = {
             "from": from_date,
@@ -208,15 +432,26 @@ def list_user_recordings(user_id: str, token_container: dict, from_date: str, to
         if next_token:
             params["next_page_token"] = next_token
 
-        data = zoom_get(f"/users/{user_id}/recordings", token_container, params=params, refresh_token_callback=refresh_token_callback)
-        meetings.extend(data.get("meetings", []))
+        data = zoom_get(session, f"/users/{user_id}/recordings", token_container, params=params, refresh_token_callback=refresh_token_callback, cache_path=cache_path, cache_ttl=LISTING_CACHE_TTL)
+        page_meetings = data.get("meetings", [])
+        meetings.extend(page_meetings)
         next_token = data.get("next_page_token")
+
+        # next_page_token values expire, so only single-page windows are worth caching; a listing with files
+        # Zoom is still processing must be fetched again so the finished files are picked up
+        if cache_path and (next_token or any(
+            rf.get("status", "completed") != "completed"
+            for m in page_meetings for rf in m.get("recording_files", []) or []
+        )):
+            cache_path.unlink(missing_ok=True)
+            cache_path = None
+
         if not next_token:
             break
 
     return meetings
 
-def list_account_users(token_container: dict, refresh_token_callback: Callable[[], str] | None = None) -> list[dict]:
+def list_account_users(session: requests.Session, token_container: dict, refresh_token_callback: Callable[[str | None], str] | None = None) -> list[dict]:
     """
     List all users in the Zoom account.
     GET /users - Returns all users in the account.
@@ -233,7 +468,7 @@ def list_account_users(token_container: dict, refresh_token_callback: Callable[[
         if next_token:
             params["next_page_token"] = next_token
 
-        data = zoom_get("/users", token_container, params=params, refresh_token_callback=refresh_token_callback)
+        data = zoom_get(session, "/users", token_container, params=params, refresh_token_callback=refresh_token_callback)
         users.extend(data.get("users", []))
         next_token = data.get("next_page_token")
         if not next_token:
@@ -241,130 +476,226 @@ def list_account_users(token_container: dict, refresh_token_callback: Callable[[
 
     return users
 
-def main():
-    # === REQUIRED ENV VARS ===
-    account_id = env("ZOOM_ACCOUNT_ID")
-    client_id = env("ZOOM_CLIENT_ID")
-    client_secret = env("ZOOM_CLIENT_SECRET")
-
-    # user_id can be: "all" (default - all users), "me" (current user), a Zoom userId, or an email
-    # If not set, defaults to "all" to get all org recordings
-    user_id = os.environ.get("ZOOM_USER_ID", "all")
+def setup_logging() -> None:
+    """
+    Route log records through a queue so worker threads only enqueue; a background
+    listener does the actual (blocking) writes to stderr.
+    """
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    atexit.register(listener.stop)  # flush queued records on any exit, including SystemExit
 
-    # Local output folder (optional, defaults to ./zoom_recordings)
-    out_dir = pathlib.Path(os.environ.get("ZOOM_OUT_DIR", "./zoom_recordings")).expanduser().resolve()
+def main():
+    setup_logging()
+    config = load_config()
 
-    # How far back to pull (months, optional, defaults to 4)
-    months_back = int(os.environ.get("ZOOM_MONTHS_BACK", "4"))
+    # One pooled session for api.zoom.us (carries the bearer token) and one for
+    # recording downloads, which redirect to CDN hosts that must not see the header
+    api_session = make_session()
+    download_session = make_session()
 
-    print("Getting access token...")
-    access_token = get_s2s_access_token(account_id, client_id, client_secret)
+    log.info("Getting access token...")
+    access_token, expires_at = get_s2s_access_token(api_session, config.account_id, config.client_id, config.client_secret)
     
     # Create token container for refreshable token management
-    token_container = {"token": access_token}
+    token_container = {"token": access_token, "expires_at": expires_at}
+    api_session.headers["Authorization"] = f"Bearer {access_token}"
+    token_lock = threading.Lock()
     
     # Create token refresh callback function
-    def refresh_token():
-        """Refresh the access token and update the container."""
-        new_token = get_s2s_access_token(account_id, client_id, client_secret)
-        token_container["token"] = new_token
-        return new_token
-
-    manifest = load_manifest(out_dir)
+    def refresh_token(stale_token: str | None = None) -> str:
+        """
+        Refresh the access token and update the container and API session.
+        With no argument, only refreshes when the token is about to expire; with a token the server
+        rejected, refreshes unless another thread already replaced it. Serialized so parallel workers
+        share a single refresh.
+        """
+        with token_lock:
+            current = token_container["token"]
+            if stale_token is None and not token_expiring(token_container):
+                return current
+            if stale_token is not None and current != stale_token:
+                return current
+            if stale_token is None:
+                log.info("Access token about to expire, refreshing...")
+            new_token, expires_at = get_s2s_access_token(api_session, config.account_id, config.client_id, config.client_secret)
+            token_container["token"] = new_token
+            token_container["expires_at"] = expires_at
+            api_session.headers["Authorization"] = f"Bearer {new_token}"
+            return new_token
+
+    # Polite pacing shared by all download workers (avoid tripping rate limits too fast)
+    limiter = RateLimiter(config.download_interval)
+
+    def download(download_url: str, out_path: pathlib.Path, expected_size: int | None) -> None:
+        limiter.wait()
+        log.info(f"Downloading {out_path.name} -> {out_path}")
+        stream_download(download_session, download_url, out_path, token_container=token_container, refresh_token_callback=refresh_token, chunk_size=config.chunk_size, expected_size=expected_size)
+
+    manifest = load_manifest(config.out_dir)
+    # Keys of files already downloaded, for O(1) membership checks in the per-file loop
+    done = set(manifest["downloaded"])
+
+    def record_download(key: str, out_path: pathlib.Path, from_date: str, to_date: str, user_id: str, user_email: str) -> None:
+        entry = {
+            "saved_to": str(out_path),
+            "downloaded_at": dt.datetime.now(dt.UTC).isoformat().replace("+00:00", "Z"),
+            "from": from_date,
+            "to": to_date,
+            "user_id": user_id,
+            "user_email": user_email,
+        }
+        manifest["downloaded"][key] = entry
+        append_manifest(config.out_dir, "downloaded", key, entry)
+        done.add(key)
 
-    windows = month_windows_back(months_back)
+    windows = month_windows_back(config.months_back)
     total_files = 0
     downloaded = 0
 
     # Determine which users to process
-    if user_id and user_id != "all":
+    if config.user_id and config.user_id != "all":
         # Single user mode (backward compatible)
-        users_to_process = [{"id": user_id, "email": user_id}]
-        print(f"Processing recordings for user: {user_id}")
+        users_to_process = [{"id": config.user_id, "email": config.user_id}]
+        log.info(f"Processing recordings for user: {config.user_id}")
     else:
         # Get all users in the account
-        print("Fetching all users in the account...")
-        all_users = list_account_users(token_container, refresh_token_callback=refresh_token)
+        log.info("Fetching all users in the account...")
+        all_users = list_account_users(api_session, token_container, refresh_token_callback=refresh_token)
         users_to_process = all_users
-        print(f"Found {len(users_to_process)} users. Processing recordings for all users...")
-
-    for user in users_to_process:
-        current_user_id = user.get("id") or user.get("email") or "me"
-        user_email = user.get("email", current_user_id)
-        print(f"\n{'='*60}")
-        print(f"Processing user: {user_email} ({current_user_id})")
-        print(f"{'='*60}")
-
-        for (from_date, to_date) in windows:
-            print(f"\nListing recordings for {current_user_id} from {from_date} to {to_date} ...")
-            meetings = list_user_recordings(current_user_id, token_container, from_date, to_date, refresh_token_callback=refresh_token)
-            print(f"Found {len(meetings)} meetings in this window.")
-
-            for m in meetings:
-                topic = sanitize(m.get("topic", "untitled"))
-                start_time = m.get("start_time") or "unknown_start"
-                start_time_safe = sanitize(start_time.replace(":", "-"))
-                meeting_id = str(m.get("uuid") or m.get("id") or "unknown_meeting")
-
-                # Include user_id in path to avoid conflicts between users
-                base = out_dir / sanitize(user_email, 60) / f"{start_time_safe} - {topic}" / sanitize(meeting_id, 80)
-
-                for rf in m.get("recording_files", []) or []:
-                    total_files += 1
-                    file_id = rf.get("id") or rf.get("recording_end") or rf.get("file_type") or str(total_files)
-                    file_type = (rf.get("file_type") or "FILE").upper()
-                    ext = (rf.get("file_extension") or "").lower()
-
-                    # Some types come without extension; give helpful defaults
-                    if not ext:
-                        ext = {
-                            "MP4": "mp4",
-                            "M4A": "m4a",
-                            "CHAT": "txt",
-                            "VTT": "vtt",
-                            "TRANSCRIPT": "vtt",
-                        }.get(file_type, "bin")
-
-                    download_url = rf.get("download_url")
-                    if not download_url:
+        log.info(f"Found {len(users_to_process)} users. Processing recordings for all users...")
+
+    # Listings run on their own pool: all of a user's windows are listed concurrently over the pooled
+    # session, and the next user's windows are queued while the current user's files download
+    list_executor = ThreadPoolExecutor(max_workers=config.list_parallel)
+    # One download pool for the whole run, so each worker keeps its thread-local read buffer across windows
+    download_executor = ThreadPoolExecutor(max_workers=config.parallel)
+
+    def submit_listings(user_id: str) -> list[Future]:
+        return [
+            list_executor.submit(list_user_recordings, api_session, user_id, token_container, from_date, to_date, refresh_token_callback=refresh_token, cache_dir=config.out_dir / ".cache" / "listings")
+            for (from_date, to_date) in windows
+        ]
+
+    user_ids = [user.get("id") or user.get("email") or "me" for user in users_to_process]
+    next_listings = submit_listings(user_ids[0]) if user_ids else []
+
+    try:
+        for i, user in enumerate(users_to_process):
+            current_user_id = user_ids[i]
+            user_email = user.get("email", current_user_id)
+            log.info(f"\n{'='*60}")
+            log.info(f"Processing user: {user_email} ({current_user_id})")
+            log.info(f"{'='*60}")
+
+            log.info(f"\nListing recordings for {current_user_id} in {len(windows)} windows ...")
+            listings = next_listings
+            if i + 1 < len(user_ids):
+                next_listings = submit_listings(user_ids[i + 1])
+
+            for (from_date, to_date), listing in zip(windows, listings):
+                meetings = listing.result()
+                log.info(f"\nFound {len(meetings)} meetings from {from_date} to {to_date}.")
+                # manifest key -> pending download, plus the paths those downloads write; a file listed twice, or two
+                # files resolving to one path, are queued once instead of two workers racing on the same .part file
+                jobs = {}
+                queued_paths = set()
+                # meeting key -> whether the meeting can be marked complete once its downloads finish
+                window_meetings = {}
+
+                for m in meetings:
+                    recording_files = m.get("recording_files", []) or []
+                    meeting_id = str(m.get("uuid") or m.get("id") or "unknown_meeting")
+                    meeting_key = f"{current_user_id}:{meeting_id}"
+                    if manifest["complete_meetings"].get(meeting_key):
+                        total_files += len(recording_files)
                         continue
-
-                    out_name = f"{file_type}.{ext}"
-                    out_path = base / out_name
-
-                    # Include user_id in manifest key to avoid conflicts
-                    key = f"{current_user_id}:{meeting_id}:{file_id}:{out_name}"
-                    if manifest["downloaded"].get(key):
-                        continue
-
-                    # Add access_token to download_url for protected recordings  [oai_citation:5‡Harvard APIs Portal](https://portal.apis.huit.harvard.edu/docs/ccs-zoom-api/1/routes/users/%7BuserId%7D/recordings/get?utm_source=chatgpt.com)
-                    # Use current token from container (may be refreshed during execution)
-                    final_url = add_access_token_to_download_url(download_url, token_container["token"])
-
-                    print(f"Downloading {out_name} -> {out_path}")
+                    # Files Zoom is still processing may change or appear later, so only settle finished meetings
+                    window_meetings[meeting_key] = bool(recording_files) and all(
+                        rf.get("status", "completed") == "completed" for rf in recording_files
+                    )
+
+                    topic = sanitize(m.get("topic", "untitled"))
+                    start_time = m.get("start_time") or "unknown_start"
+                    start_time_safe = sanitize(start_time.replace(":", "-"))
+
+                    # Include user_id in path to avoid conflicts between users
+                    base = config.out_dir / sanitize(user_email, 60) / f"{start_time_safe} - {topic}" / sanitize(meeting_id, 80)
+
+                    for rf in recording_files:
+                        total_files += 1
+                        file_id = rf.get("id") or rf.get("recording_end") or rf.get("file_type") or str(total_files)
+                        file_type = (rf.get("file_type") or "FILE").upper()
+                        ext = (rf.get("file_extension") or "").lower()
+
+                        # Some types come without extension; give helpful defaults
+                        if not ext:
+                            ext = _EXT_BY_TYPE.get(file_type, "bin")
+
+                        download_url = rf.get("download_url")
+                        if not download_url:
+                            continue
+
+                        # A meeting can have several files of one type (separate views, paused segments), so the
+                        # recording type and file id keep each one at its own path while they download in parallel
+                        name_parts = [file_type]
+                        if rf.get("recording_type"):
+                            name_parts.append(sanitize(rf["recording_type"], 60))
+                        name_parts.append(sanitize(str(file_id), 80))
+                        out_name = f"{' - '.join(name_parts)}.{ext}"
+                        out_path = base / out_name
+
+                        # Include user_id in manifest key to avoid conflicts; the key keeps the original
+                        # FILE_TYPE.ext name so manifests written by earlier versions still match
+                        key = f"{current_user_id}:{meeting_id}:{file_id}:{file_type}.{ext}"
+                        if key in done or key in jobs:
+                            continue
+
+                        # A file already on disk with the size Zoom reports (e.g. the manifest was lost) needs no transfer
+                        expected_size = int(rf["file_size"]) if rf.get("file_size") else None
+                        if expected_size and out_path.exists() and out_path.stat().st_size == expected_size:
+                            record_download(key, out_path, from_date, to_date, current_user_id, user_email)
+                            continue
+
+                        if out_path in queued_paths:
+                            log.error(f"  !! Skipping {key}: {out_path} is already being downloaded for another file")
+                            window_meetings[meeting_key] = False
+                            continue
+
+                        jobs[key] = (download_url, out_path, meeting_key, expected_size)
+                        queued_paths.add(out_path)
+
+                # Download this window's files concurrently on the run-wide pool; manifest updates stay on this thread
+                futures = {
+                    download_executor.submit(download, download_url, out_path, expected_size): (out_path, key, meeting_key)
+                    for key, (download_url, out_path, meeting_key, expected_size) in jobs.items()
+                }
+                for future in as_completed(futures):
+                    out_path, key, meeting_key = futures[future]
                     try:
-                        stream_download(final_url, out_path, token_container=token_container, refresh_token_callback=refresh_token)
+                        future.result()
                     except Exception as e:
-                        print(f"  !! Failed: {e}")
+                        log.error(f"  !! Failed {out_path}: {e}")
+                        window_meetings[meeting_key] = False
                         continue
 
-                    manifest["downloaded"][key] = {
-                        "saved_to": str(out_path),
-                        "downloaded_at": dt.datetime.utcnow().isoformat() + "Z",
-                        "from": from_date,
-                        "to": to_date,
-                        "user_id": current_user_id,
-                        "user_email": user_email,
-                    }
+                    record_download(key, out_path, from_date, to_date, current_user_id, user_email)
                     downloaded += 1
 
-                    # polite pacing (avoid tripping rate limits too fast)
-                    time.sleep(0.2)
-
-            save_manifest(out_dir, manifest)
-
-    print(f"\nDone. Files seen: {total_files}, newly downloaded: {downloaded}")
-    print(f"Output folder: {out_dir}")
+                # Meetings with every file downloaded are skipped outright on later runs
+                for meeting_key, complete in window_meetings.items():
+                    if complete:
+                        manifest["complete_meetings"][meeting_key] = True
+                        append_manifest(config.out_dir, "complete_meetings", meeting_key, True)
+    finally:
+        # Drop listings and downloads still queued when the run stops early (e.g. on an API error or Ctrl-C)
+        list_executor.shutdown(cancel_futures=True)
+        download_executor.shutdown(cancel_futures=True)
+
+    log.info(f"\nDone. Files seen: {total_files}, newly downloaded: {downloaded}")
+    log.info(f"Output folder: {config.out_dir}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file